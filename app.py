@@ -1,11 +1,23 @@
 import streamlit as st
 import re
-from onebanc import check_mpin
+from onebanc import check_mpin, build_personal_index, PopularitySketch
 from datetime import date, timedelta
 import streamlit.components.v1 as components
 
 
 
+@st.cache_resource
+def get_popularity_sketch():
+    """
+    Open the shared MPIN popularity sketch once per server process.
+    Returns (sketch, error); on failure sketch is None so the other MPIN
+    rules keep working without the popularity check.
+    """
+    try:
+        return PopularitySketch(), None
+    except (ValueError, OSError) as e:
+        return None, str(e)
+
 def local_css(file_name):
     """Load local CSS file"""
     with open(file_name) as f:
@@ -336,6 +348,11 @@ def main():
     # Apply custom theme
     set_custom_theme()
     
+    # Open the popularity sketch up front; if it is broken, warn and skip it
+    sketch, sketch_error = get_popularity_sketch()
+    if sketch_error:
+        st.error(f"MPIN popularity check unavailable: {sketch_error}")
+    
     # Add animation
     animate_text()
     
@@ -453,8 +470,11 @@ def main():
                 dob_spouse_str = dob_spouse.strftime("%Y%m%d") if dob_spouse else None
                 anniversary_str = anniversary.strftime("%Y%m%d") if anniversary else None
 
-                # Check MPIN
-                violations = check_mpin(pin, dob_self_str, dob_spouse_str, anniversary_str)
+                # Index personal data once for this submission, then check MPIN
+                personal_index = build_personal_index(phone, dob_self_str, dob_spouse_str, anniversary_str)
+                violations = check_mpin(pin, dob_self_str, dob_spouse_str, anniversary_str,
+                                        personal_index=personal_index,
+                                        sketch=sketch)
 
                 if not violations:
                     st.markdown("""
@@ -497,6 +517,7 @@ def main():
                             <li>Should not relate to your personal information</li>
                             <li>Should not use only even or only odd digits</li>
                             <li>Should not be a palindrome or have simple repeating patterns</li>
+                            <li>Should not be an MPIN many other customers already use</li>
                         </ul>
                     </div>
                     """, unsafe_allow_html=True)
@@ -1,5 +1,16 @@
 
+import hashlib
+import mmap
+import os
 import re
+import secrets
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process file locking
+    fcntl = None
 
 # Constants for violation types
 PATTERN_VIOLATION = 'PATTERN_VIOLATION: Common pattern detected'
@@ -14,6 +25,7 @@ ALL_SAME_TYPE = 'ALL_SAME_TYPE: All digits are even or all digits are odd'
 MATHEMATICAL_PATTERN = 'MATHEMATICAL_PATTERN: Special mathematical sequence'
 LAZY_REPEAT = 'LAZY_REPEAT: Simple repetition pattern'
 ALTERNATING_DIGITS = 'ALTERNATING_DIGITS: Alternating digit pattern'
+POPULAR_PIN = 'POPULAR_PIN: Too many customers already use this MPIN'
 
 # Define common geometric patterns on keypad
 KEYPAD_PATTERNS = [
@@ -39,9 +51,99 @@ MATHEMATICAL_PATTERNS = [
     '100489', '117649', '262144',  # Perfect squares/cubes examples
 ]
 
-def check_mpin(pin, dob_self=None, dob_spouse=None, anniversary=None):
+# Shortest run of PIN digits that counts as a match against personal data
+PERSONAL_RUN_LENGTH = 4
+
+# Trailing account number digits included in the personal data index
+ACCOUNT_TAIL_LENGTH = 6
+
+def date_variants(date_str):
+    """
+    Expand a YYYYMMDD date into the digit orders people commonly write it in.
+    """
+    yyyy, mm, dd = date_str[:4], date_str[4:6], date_str[6:]
+    yy = yyyy[2:]
+    return [
+        yyyy + mm + dd, dd + mm + yyyy, mm + dd + yyyy,
+        yy + mm + dd, dd + mm + yy, mm + dd + yy,
+    ]
+
+def build_personal_index(phone=None, dob_self=None, dob_spouse=None,
+                         anniversary=None, account_number=None):
+    """
+    Build an Aho-Corasick automaton over every PERSONAL_RUN_LENGTH-digit run
+    of the customer's personal data (forward and reversed).
+    Any longer shared run contains one of these, so a single pass over the
+    PIN finds a match of 4 or more digits, including ones in the reversed PIN.
+    Returns (goto, fail, out) where out[state] is True on a match.
+    """
+    sources = []
+    for date_str in [dob_self, dob_spouse, anniversary]:
+        if date_str and re.fullmatch(r"\d{8}", date_str):
+            sources.extend(date_variants(date_str))
+    if phone and re.fullmatch(r"\d{10}", phone):
+        sources.append(phone)
+    if account_number:
+        digits = re.sub(r"\D", "", account_number)
+        if len(digits) >= PERSONAL_RUN_LENGTH:
+            sources.append(digits[-ACCOUNT_TAIL_LENGTH:])
+    
+    patterns = set()
+    for source in sources:
+        for text in (source, source[::-1]):
+            for i in range(len(text) - PERSONAL_RUN_LENGTH + 1):
+                patterns.add(text[i:i + PERSONAL_RUN_LENGTH])
+    
+    # Trie of all patterns
+    goto, fail, out = [{}], [0], [False]
+    for pattern in patterns:
+        state = 0
+        for ch in pattern:
+            if ch not in goto[state]:
+                goto.append({})
+                fail.append(0)
+                out.append(False)
+                goto[state][ch] = len(goto) - 1
+            state = goto[state][ch]
+        out[state] = True
+    
+    # Failure links, breadth first
+    queue = list(goto[0].values())
+    for state in queue:
+        for ch, nxt in goto[state].items():
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            out[nxt] = out[nxt] or out[fail[nxt]]
+            queue.append(nxt)
+    
+    return goto, fail, out
+
+def matches_personal_index(index, pin):
+    """
+    Scan the PIN once through the automaton from build_personal_index.
+    Returns True if any run of PERSONAL_RUN_LENGTH+ digits is personal data.
+    """
+    goto, fail, out = index
+    state = 0
+    for ch in pin:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if out[state]:
+            return True
+    return False
+
+def check_mpin(pin, dob_self=None, dob_spouse=None, anniversary=None,
+               phone=None, account_number=None, personal_index=None,
+               sketch=None):
     """
     Check if the MPIN follows any common patterns.
+    Pass personal_index from build_personal_index to reuse it across checks;
+    it then replaces phone and account_number, which are only used to build
+    the index when none is given. The dates still feed the digit-overlap check.
+    Pass a PopularitySketch to also reject PINs too many customers use.
     Returns a list of violations if found, or empty list if secure.
     """
     violations = []
@@ -99,28 +201,164 @@ def check_mpin(pin, dob_self=None, dob_spouse=None, anniversary=None):
         violations.append(ALTERNATING_DIGITS)
     
     # Check for demographic matches
-    for date_str in [dob_self, dob_spouse, anniversary]:
-        if date_str and re.fullmatch(r"\d{8}", date_str):
-            # Check if PIN is contained in the date
-            if pin in date_str:
-                violations.append(DEMOGRAPHIC_MATCH)
-                break
-            
-            # Check for significant digit overlap
-            date_digits = {d: date_str.count(d) for d in set(date_str)}
-            pin_digits = {d: pin.count(d) for d in set(pin)}
-            
-            common_digits = 0
-            for digit in pin_digits:
-                if digit in date_digits and pin_digits[digit] <= date_digits[digit]:
-                    common_digits += pin_digits[digit]
-            
-            if common_digits >= 4:  # If 4+ digits match in frequency
-                violations.append(DEMOGRAPHIC_MATCH)
-                break
+    if personal_index is None:
+        personal_index = build_personal_index(phone, dob_self, dob_spouse,
+                                              anniversary, account_number)
+    
+    # Check if PIN (or its reversal) shares a 4+ digit run with personal data
+    if matches_personal_index(personal_index, pin):
+        violations.append(DEMOGRAPHIC_MATCH)
+    else:
+        for date_str in [dob_self, dob_spouse, anniversary]:
+            if date_str and re.fullmatch(r"\d{8}", date_str):
+                # Check for significant digit overlap
+                date_digits = {d: date_str.count(d) for d in set(date_str)}
+                pin_digits = {d: pin.count(d) for d in set(pin)}
+                
+                common_digits = 0
+                for digit in pin_digits:
+                    if digit in date_digits and pin_digits[digit] <= date_digits[digit]:
+                        common_digits += pin_digits[digit]
+                
+                if common_digits >= 4:  # If 4+ digits match in frequency
+                    violations.append(DEMOGRAPHIC_MATCH)
+                    break
+    
+    # Check how many customers already chose this PIN
+    if sketch is not None and sketch.estimate(pin) >= POPULARITY_THRESHOLD:
+        violations.append(POPULAR_PIN)
     
     return violations
 
+# Count-min sketch of MPIN popularity: SKETCH_DEPTH rows of SKETCH_WIDTH
+# 32-bit counters (1 MiB), fixed regardless of the number of customers
+SKETCH_DEPTH = 4
+SKETCH_WIDTH = 1 << 16
+SKETCH_MAGIC = b'MPINCMS2'
+SKETCH_FINGERPRINT_SIZE = 16
+SKETCH_HEADER = struct.Struct(f'<8sII{SKETCH_FINGERPRINT_SIZE}s')
+SKETCH_COUNTER_MAX = 0xFFFFFFFF
+POPULARITY_THRESHOLD = 100
+
+def _create_exclusive(path, data, size=None):
+    """
+    Atomically create path holding data (zero-padded to size) unless it exists.
+    The file is built under a temporary name and linked into place, so other
+    processes never see it partially written.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if size is not None:
+                f.truncate(size)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass  # Created earlier or by another process
+    finally:
+        os.unlink(tmp_path)
+
+class PopularitySketch:
+    """
+    Memory-mapped count-min sketch of how many customers chose each MPIN.
+    Only keyed hashes of PINs touch the counters, so PINs are never stored.
+    The key comes from ONEBANC_SKETCH_KEY or its own file, created on first
+    use, and a fingerprint of it in the header ties the counters to that key.
+    Paths default to ONEBANC_SKETCH_PATH / ONEBANC_SKETCH_KEY_PATH, else files
+    next to this module.
+    """
+    
+    def __init__(self, path=None, key_path=None):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        path = path or os.environ.get('ONEBANC_SKETCH_PATH') \
+            or os.path.join(base_dir, 'mpin_sketch.bin')
+        key_path = key_path or os.environ.get('ONEBANC_SKETCH_KEY_PATH') \
+            or os.path.join(base_dir, 'mpin_sketch.key')
+        
+        key = os.environ.get('ONEBANC_SKETCH_KEY')
+        raw_key = key.encode() if key else self._load_key(key_path)
+        # BLAKE2b keys are capped at 64 bytes, so derive a fixed-size one
+        self.key = hashlib.blake2b(raw_key, digest_size=32).digest()
+        fingerprint = hashlib.blake2b(b'MPIN sketch key check', key=self.key,
+                                      digest_size=SKETCH_FINGERPRINT_SIZE).digest()
+        
+        size = SKETCH_HEADER.size + SKETCH_DEPTH * SKETCH_WIDTH * 4
+        if not os.path.exists(path):
+            header = SKETCH_HEADER.pack(SKETCH_MAGIC, SKETCH_DEPTH,
+                                        SKETCH_WIDTH, fingerprint)
+            _create_exclusive(path, header, size)
+        
+        if os.path.getsize(path) != size:
+            raise ValueError(f"{path} is not a compatible MPIN sketch file")
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), size)
+        header = SKETCH_HEADER.unpack_from(self._map)
+        if header[:3] != (SKETCH_MAGIC, SKETCH_DEPTH, SKETCH_WIDTH):
+            self.close()
+            raise ValueError(f"{path} is not a compatible MPIN sketch file")
+        if not secrets.compare_digest(header[3], fingerprint):
+            self.close()
+            raise ValueError(f"{path} was built with a different MPIN sketch key")
+        self._counters = memoryview(self._map)[SKETCH_HEADER.size:].cast('I')
+        # Streamlit sessions share one instance across threads
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _load_key(key_path):
+        if not os.path.exists(key_path):
+            _create_exclusive(key_path, secrets.token_bytes(32))
+        with open(key_path, 'rb') as f:
+            key = f.read()
+        if not key:
+            raise ValueError(f"{key_path} is empty; delete it to generate a new key")
+        return key
+    
+    def _slots(self, pin):
+        """Counter index in each row for the keyed hash of the PIN"""
+        digest = hashlib.blake2b(pin.encode(), key=self.key,
+                                 digest_size=4 * SKETCH_DEPTH).digest()
+        return [row * SKETCH_WIDTH + (h % SKETCH_WIDTH)
+                for row, (h,) in enumerate(struct.iter_unpack('<I', digest))]
+    
+    def estimate(self, pin):
+        """Upper-bound estimate of how many customers registered this PIN"""
+        return min(self._counters[i] for i in self._slots(pin))
+    
+    def register(self, pin, threshold=POPULARITY_THRESHOLD):
+        """
+        Registration hook: call once per customer ID when their MPIN is set.
+        Re-checks popularity under the lock so concurrent registrations cannot
+        push a PIN past the threshold. Returns True if the PIN was accepted and
+        counted (conservative update keeps overcounting low), False otherwise.
+        """
+        slots = self._slots(pin)
+        with self._lock:
+            # Other server processes may map the same file
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                current = min(self._counters[i] for i in slots)
+                if current >= threshold:
+                    return False
+                target = min(current + 1, SKETCH_COUNTER_MAX)
+                for i in slots:
+                    if self._counters[i] < target:
+                        self._counters[i] = target
+                self._map.flush()
+                return True
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+    
+    def close(self):
+        if getattr(self, '_counters', None) is not None:
+            self._counters.release()
+            self._counters = None
+        self._map.close()
+        self._file.close()
+
 # def main():
 #     print("=== Secure 6-digit MPIN Validator ===")
 #     print("This program checks if your MPIN follows common patterns that should be avoided.")